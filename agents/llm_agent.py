@@ -1,31 +1,300 @@
 import asyncio
 import aiohttp
+import heapq
+import html
 import discord
 import os
-from datetime import datetime
-from collections import deque
-from bs4 import BeautifulSoup  # For stripping HTML content
+import random
+import time
+from functools import lru_cache
+from collections import OrderedDict, deque
 from discord import ButtonStyle
 from discord.ui import Button, View
 import re
 import json
 
+try:
+    import orjson  # Optional: much faster JSON encoding/decoding for large payloads
+except ImportError:
+    orjson = None
+
+from agents.rate_limiter import BACKOFF_STATUSES, RateLimiter
+
+
+# Matches anything that looks like an HTML tag or entity; messages without one skip the HTML parser
+_HTML_RE = re.compile(r'<[^>]+>|&#?\w+;')
+
+# Used by _html_to_text: script/style elements (not visible text) and the remaining tags and comments
+_SCRIPT_STYLE_RE = re.compile(r'<(script|style)\b[^>]*>.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r'<!--.*?-->|</?[a-zA-Z][^>]*>', re.DOTALL)
+
+
+def _has_html(content):
+    """Whether content needs the HTML parser; the substring checks rule out plain text before the regex runs."""
+    return ('<' in content or '&' in content) and _HTML_RE.search(content) is not None
+
+
+def _json_dumps(obj):
+    """Serialize obj to UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _json_loads(text):
+    """Parse JSON from str or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _start_task(coro):
+    """
+    Start a task for one of the agent's own requests.
+
+    On Python 3.12+ the task runs its first step right away, so a request that finishes
+    without suspending (a cache hit, a fast failure) never waits on the event loop. Only the
+    agent's fan-out uses this; the loop's own task factory is left alone for discord.py and aiohttp.
+
+    Args:
+        coro (coroutine): The coroutine to run.
+
+    Returns:
+        asyncio.Task: The task.
+    """
+    if hasattr(asyncio, 'eager_task_factory'):
+        return asyncio.eager_task_factory(asyncio.get_running_loop(), coro)
+    return asyncio.ensure_future(coro)
+
+
+# Termination tags some models emit; the response is cut at the first one
+_TERMINATION_RE = re.compile('|'.join(map(re.escape, ["</stop>", "</xml>", "<|end|>", "<|endoftext|>"])))
+
+# Patterns used by LLMAgent._clean_oblique_tags. The whitespace patterns only match runs
+# that actually change, so bare newlines and single spaces between words are left alone
+_OBLIQUE_USER_TAG_RE = re.compile(r'\[oblique:[^\]]*\]')
+_NEWLINE_PADDING_RE = re.compile(r'[ \t]+\n[ \t]*|\n[ \t]+')
+_INLINE_SPACE_RE = re.compile(r'\t[ \t]*| [ \t]+')
+
+# Characters that rule out text being a username (used for stop sequences and speaker lines)
+_INVALID_NAME_CHARS = frozenset('.,!?;()[]{}|\\/"<>+=*&^%$#@`~')
+
+@lru_cache(maxsize=128)
+def _xml_speaker_tag_re(name):
+    """A "<name>" tag, matched case-insensitively (cached per speaker name)."""
+    return re.compile(r'<((?i:' + re.escape(name) + r'))>')
+
+
+# Used by LLMAgent._is_likely_speaker_line_colon: a first colon within 30 characters, no
+# punctuation unlikely in names before it, not the "://" of a URL, and something other
+# than whitespace after it
+_SPEAKER_LINE_RE = re.compile(
+    r'([^:' + re.escape(''.join(sorted(_INVALID_NAME_CHARS))) + r']{0,30}):(?!//)(?=.*?\S)', re.DOTALL
+)
+
+# User (<@id>, <@!id>) and role (<@&id>) mentions in raw message content
+_MENTION_RE = re.compile(r'<@([!&]?)(\d+)>')
+
+_BRACKETED_RE = re.compile(r'\[.*?\]')
+
+# Discord message links, and the "last: <link>" line of a .history branch marker
+_MESSAGE_URL_RE = re.compile(r'https?://(?:www\.)?discord\.com/channels/(\d+)/(\d+)/(\d+)')
+_BRANCH_LAST_RE = re.compile(r'last:\s*(https?://(?:www\.)?discord\.com/channels/\d+/\d+/\d+)')
+
+
+@lru_cache(maxsize=1024)
+def _strip_bracketed(username):
+    """Remove square bracket content from a name (cached: the same few names recur constantly)."""
+    return _BRACKETED_RE.sub('', username).strip()
+
+
+def _html_to_text(content):
+    """Strip HTML tags and entities from a message, keeping its text."""
+    return html.unescape(_TAG_RE.sub('', _SCRIPT_STYLE_RE.sub('', content)))
+
+
+def create_connector(config):
+    """
+    Create the connection pool for provider requests.
+
+    Connections are kept alive between prompts and DNS lookups are cached, so
+    requests to an endpoint skip the TCP/TLS handshake and the resolver.
+
+    Args:
+        config (Config): The bot configuration.
+
+    Returns:
+        aiohttp.TCPConnector: The connector.
+    """
+    return aiohttp.TCPConnector(
+        limit=config.CONNECTION_LIMIT,
+        limit_per_host=config.CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout=75,
+        ttl_dns_cache=300
+    )
+
+
+# Returned by _format_message_line for an oblique_clear message, which ends the history
+_CLEAR_MARKER = object()
+
+
+class _RecentCompletions:
+    """
+    Fixed-size ring of a user's most recent completions, oldest first when iterated.
+
+    Smaller than a deque(maxlen=...) per user, which matters once many users have
+    triggered the bot.
+    """
+
+    __slots__ = ('items', 'next_index')
+
+    def __init__(self, size=10):
+        self.items = [None] * size
+        self.next_index = 0
+
+    def append(self, entry):
+        self.items[self.next_index] = entry
+        self.next_index = (self.next_index + 1) % len(self.items)
+
+    def __iter__(self):
+        index = self.next_index
+        return (entry for entry in self.items[index:] + self.items[:index] if entry is not None)
+
+    def __len__(self):
+        return sum(entry is not None for entry in self.items)
+
 
 class LLMAgent:
-    def __init__(self, name, config, callback, model_config=None):
+    def __init__(self, name, config, callback, model_config=None, history_cache=None, connector=None,
+                 rate_limiter=None):
         self.name = name
         self.config = config
         self.model_config = model_config or config.get_model_config(config.get_default_model_key())
         self.callback = callback  # Function to call with the response
+        # Recent completions per user, least recently active first; idle users are evicted
+        self.message_history = OrderedDict()  # Format: {user_id: (monotonic time, _RecentCompletions)}
+        self.message_history_ttl = 24 * 3600
+        self.message_history_max_users = 1024
+        self.history_cache = history_cache  # Shared ChannelHistoryCache, if the bot keeps one
+        # Formatted prompt line per message ID, so consecutive prompts over mostly the
+        # same history only format the messages that are new or edited
+        self._line_cache = OrderedDict()  # Format: {message_id: (content, line)}
+        self._line_cache_size = config.MESSAGE_HISTORY_LIMIT * 4
+        # Recently formatted histories for regenerations of the same trigger
+        self._prompt_cache = OrderedDict()  # Format: {(channel_id, message_id): (monotonic time, (formatted, stop_sequences))}
+        self._prompt_cache_ttl = 30
+        # Uncached messages above which formatting moves off the event loop; smaller batches
+        # cost less than the thread hop
+        self._thread_format_min = 32
         self.state = {}
-        self.queue = asyncio.Queue()
-        self.session = aiohttp.ClientSession()
+        # Bounded so a slow provider cannot pile up triggers that go stale before they run
+        self.queue = asyncio.Queue(maxsize=32)
+        # Retry backoff policy: exponential from retry_base_delay up to retry_max_delay per wait,
+        # giving up once a request has spent max_retry_wait seconds in backoff
+        self.retry_base_delay = config.RETRY_BASE_DELAY
+        self.retry_max_delay = config.RETRY_MAX_DELAY
+        self.max_retry_wait = config.MAX_RETRY_WAIT
+        self.max_inflight = config.AGENT_WORKERS  # Queue items handled concurrently (they share the rate limiter)
+        self._handler_slots = asyncio.Semaphore(self.max_inflight)
+        self._handler_tasks = set()
+        self._prefetch_tasks = set()  # History fetches started at enqueue time
+        self._shutdown_task = None
+        # Keep connections to the provider alive between prompts so requests skip the
+        # TCP/TLS handshake. A connector passed in is shared with other agents and closed
+        # by its owner; otherwise this agent keeps its own pool
+        owns_connector = connector is None
+        if owns_connector:
+            connector = create_connector(config)
+        # Headers are the same for every request to this model, so the session sends them
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            connector_owner=owns_connector,
+            timeout=aiohttp.ClientTimeout(total=300, sock_connect=10),
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self._get_api_key()}",
+                "Accept-Encoding": "identity",  # Avoid gzip issues with some servers
+                "X-Title": "Oblique"
+            }
+        )
         self.task = asyncio.create_task(self.process_queue())
-        self.rate_limit = asyncio.Semaphore(5)  # Adjust based on API rate limits
+        # Adaptive concurrency plus header-driven pacing for every request to this model. A
+        # limiter passed in is shared with the other agents using the same model
+        self.rate_limit = rate_limiter or RateLimiter.for_model(self.model_config)
+
+        # Request parts that are the same for every call to this model
+        self._is_instruct = self.model_config.get('type') == 'instruct'
+        self._endpoint = self.model_config.get('endpoint', '').rstrip('/')
+        self._payload_base = {"model": self.model_config.get('model_id')}
+        # Add provider settings if quantization is specified
+        if self.model_config.get('quantization'):
+            self._payload_base["provider"] = {
+                "quantizations": [self.model_config.get('quantization')]
+            }
+        # Stream completions as server-sent events (opt-in, the endpoint must support it)
+        self._stream = bool(self.model_config.get('stream', False))
+        if self._stream:
+            self._payload_base["stream"] = True
+        # Seconds between preview edits of a completion that is still streaming; Discord
+        # rate-limits message edits, so previews are throttled well below that
+        self._preview_interval = 1.5
+        self._last_request = None  # (key, payload, body) memo for _build_request
+        self._chat_prefix = [
+            {"role": "system", "content": self.model_config.get('system_prompt', '')},
+            {"role": "user", "content": self.model_config.get('user_prefix', '')}
+        ]
         
         # Set up logging directory
-        self.log_dir = "logs"
-        os.makedirs(self.log_dir, exist_ok=True)
+        self.log_dir = "logs"  # Created by the log writer, off the event loop
+        # Sanitize agent name for filesystem by replacing unsafe characters
+        safe_name = self.name.replace("/", "_").replace("\\", "_").replace(":", "_")
+        self._log_prefix = os.path.join(self.log_dir, f"{safe_name}_")
+        # Request/response logs are queued here and written to disk by a background task
+        self._log_queue = asyncio.Queue()
+        self._log_task = asyncio.create_task(self._log_writer())
+
+    def _log(self, log_file, text):
+        """
+        Queue text to be appended to a request log file without blocking the event loop.
+
+        Args:
+            log_file (str): Path of the log file.
+            text (str): Text to append.
+        """
+        self._log_queue.put_nowait((log_file, text))
+
+    async def _log_writer(self):
+        """Writes queued log records to disk, batching whatever has accumulated."""
+        try:
+            await asyncio.to_thread(os.makedirs, self.log_dir, exist_ok=True)
+        except OSError as e:
+            print(f"Error creating log directory {self.log_dir}: {e}")
+        while True:
+            records = [await self._log_queue.get()]
+            while not self._log_queue.empty():
+                records.append(self._log_queue.get_nowait())
+            try:
+                await asyncio.to_thread(self._write_log_records, records)
+            except Exception as e:
+                print(f"Error writing request log: {e}")
+            finally:
+                for _ in records:
+                    self._log_queue.task_done()
+
+    @staticmethod
+    def _write_log_records(records):
+        """
+        Appends log records to their files, opening each file once per batch.
+
+        Args:
+            records (list[tuple[str, str]]): (log_file, text) pairs in queue order.
+        """
+        by_file = {}
+        for log_file, text in records:
+            by_file.setdefault(log_file, []).append(text)
+        for log_file, texts in by_file.items():
+            with open(log_file, "a", encoding="utf-8") as f:
+                f.write("".join(texts))
 
     def _get_api_key(self):
         """
@@ -47,18 +316,33 @@ class LLMAgent:
 
     async def process_queue(self):
         while True:
+            # Wait for a free handler slot first so overflow stays in the bounded queue
+            await self._handler_slots.acquire()
             print("\nWaiting for queue item...")
-            data = await self.queue.get()
-            print(f"Processing queue item for user {data.get('username')}")
-            print(f"Model config in use: {self.model_config.get('name', 'Unknown')} ({self.model_config.get('model_id', 'Unknown')})")
             try:
-                await self.handle_message(data)
-                print("Queue item processed successfully")
-            except Exception as e:
-                print(f"Error processing queue item: {e}")
-                import traceback
-                traceback.print_exc()
+                data = await self.queue.get()
+            except BaseException:
+                self._handler_slots.release()
+                raise
+            # Handle the item in its own task so the next one can start while this
+            # one waits on the LLM
+            task = asyncio.create_task(self._process_queue_item(data))
+            self._handler_tasks.add(task)
+            task.add_done_callback(self._handler_tasks.discard)
+
+    async def _process_queue_item(self, data):
+        print(f"Processing queue item for user {data.get('username')}")
+        print(f"Model config in use: {self.model_config.get('name', 'Unknown')} ({self.model_config.get('model_id', 'Unknown')})")
+        try:
+            await self.handle_message(data)
+            print("Queue item processed successfully")
+        except Exception as e:
+            print(f"Error processing queue item: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
             self.queue.task_done()
+            self._handler_slots.release()
 
     async def handle_message(self, data):
         """
@@ -73,7 +357,12 @@ class LLMAgent:
             max_tokens = data.get('max_tokens', self.model_config.get('max_tokens', 200))
             temperature = data.get('temperature', 1)  # Default to 0.7 if not specified
 
-            formatted_messages = await self.format_messages(message, bot)
+            # Use the history prefetched while the trigger waited in the queue, if any
+            history_task = data.pop('_history_task', None)
+            if history_task is not None:
+                formatted_messages, stop_sequences = await history_task
+            else:
+                formatted_messages, stop_sequences = await self.format_messages(message, bot)
             custom_name = data.get('custom_name')
             mode = data.get('mode', 'self')
             # Handle both Message and Interaction objects
@@ -83,62 +372,102 @@ class LLMAgent:
                 name = self._clean_username(custom_name or message.author.display_name)
 
             # Add seed text if provided - use colon format for all models
-            prompt = formatted_messages
             if data.get('seed'):
-                prompt += f'{name}: {data["seed"]}'
+                prompt = f'{formatted_messages}{name}: {data["seed"]}'
             elif not data.get('suppress_name', False):
-                prompt += f'{name}:'
-
-            # Request completions - use n parameter if supported, otherwise make separate requests
-            if self.model_config.get('supports_n_parameter', False):
-                # Use single request with n=3 for models that support it
-                print(f"Using n parameter for model {self.model_config.get('name')}")
-                completions = await self.send_completion_request_with_n(prompt, max_tokens, temperature, formatted_messages, mode=mode, n=3)
+                prompt = f'{formatted_messages}{name}:'
             else:
-                # Fall back to separate requests for models that don't support n parameter
-                print(f"Using separate requests for model {self.model_config.get('name')}")
-                completion_tasks = [self.send_completion_request(prompt, max_tokens, temperature, formatted_messages, mode=mode) for _ in range(3)]
-                completions = await asyncio.gather(*completion_tasks)
-
-            print(f"Received {len(completions)} completions from API")
+                prompt = formatted_messages
 
-            # Filter out empty completions and process valid ones
+            num_completions = 3
             valid_completions = []
-            for response_text in completions:
+            preview_task = None  # The preview edit in flight, if any
+            preview_key = None  # The streaming completion being previewed: the first to produce text
+            finalizing = False  # Set once a final completion is about to be sent; no previews after that
+
+            async def preview(key, response_text):
+                # Show the first streaming completion as it grows, until any completion is final
+                nonlocal preview_task, preview_key
+                if finalizing or preview_key not in (None, key):
+                    return
+                if preview_task is not None and not preview_task.done():
+                    return  # Skip this update rather than queue edits behind a slow one
+                preview_key = key
+                partial_text = self.process_response(response_text, data)
+                if partial_text and partial_text != "Error: No response from LLM.":
+                    preview_task = asyncio.create_task(
+                        self.callback(data, partial_text, page=1, total_pages=num_completions, partial=True))
+
+            async def deliver(response_text):
+                # Filter out empty completions and send valid ones to the callback right away
+                nonlocal finalizing
                 print(f"Response text: {response_text}")
                 replacement_text = self.process_response(response_text, data)
                 if replacement_text and replacement_text != "Error: No response from LLM.":
                     print("is valid")
+                    # Stop new previews first, then let the one in flight land, so no partial
+                    # edit can be sent after (and overwrite) the final text
+                    finalizing = True
+                    if preview_task is not None:
+                        await asyncio.gather(preview_task, return_exceptions=True)
                     valid_completions.append(replacement_text)
+                    await self.callback(data, replacement_text, page=len(valid_completions), total_pages=num_completions)
+
+            # Request completions - use n parameter if supported, otherwise make separate requests.
+            # None means models.yaml does not say, so this request finds out
+            supports_n = self.model_config.get('supports_n_parameter')
+            if supports_n is not False:
+                # Use single request with n=3 for models that support it: the prompt is
+                # uploaded and prefilled once for all three samples, and each completion is
+                # delivered as soon as it is available
+                print(f"Using n parameter for model {self.model_config.get('name')}")
+                completions = await self.send_completion_request_with_n(prompt, max_tokens, temperature, stop_sequences,
+                                                                        mode=mode, n=num_completions, on_completion=deliver,
+                                                                        probe=supports_n is None, on_progress=preview)
+                print(f"Received {len(completions)} completions from API")
+            if supports_n is False or (self.model_config.get('supports_n_parameter') is False and not valid_completions):
+                # Fall back to separate requests for models that don't support n parameter (or
+                # just turned out not to), delivering each completion as soon as its request finishes
+                print(f"Using separate requests for model {self.model_config.get('name')}")
+                # Each request streams its own choice 0, so previews are keyed by request
+                completion_tasks = [
+                    _start_task(self.send_completion_request(
+                        prompt, max_tokens, temperature, stop_sequences, mode=mode,
+                        on_progress=lambda _, text, request=request: preview(('request', request), text)))
+                    for request in range(num_completions)
+                ]
+                try:
+                    for next_completion in asyncio.as_completed(completion_tasks):
+                        try:
+                            response_text = await next_completion
+                        except Exception as e:
+                            print(f"Completion request failed: {e!r}")
+                            response_text = ""
+                        await deliver(response_text)
+                finally:
+                    for task in completion_tasks:
+                        task.cancel()
 
             # Handle case when all completions are empty
             if not valid_completions:
+                if preview_task is not None:
+                    await asyncio.gather(preview_task, return_exceptions=True)
                 replacement_text = "No valid response generated. Please try again."
                 await self.callback(data, replacement_text, page=1, total_pages=1)
                 print(f"LLMAgent '{self.name}' generated no valid completions.")
                 return
 
-            # Send valid completions to callback with correct page numbers
-            total_pages = len(valid_completions)
-            for i, replacement_text in enumerate(valid_completions):
-                await self.callback(data, replacement_text, page=i + 1, total_pages=total_pages)
-
             # Handle both Message and Interaction objects
             if isinstance(message, discord.Interaction):
                 user_id = message.user.id
             else:
                 user_id = message.author.id
-            if not hasattr(self, 'message_history'):
-                self.message_history = {}
-            if user_id not in self.message_history:
-                self.message_history[user_id] = deque(maxlen=10)
-
-            self.message_history[user_id].append({
+            self._remember_completions(user_id, {
                 'id': data['generating_message_id'],
                 'content': valid_completions
             })
 
-            print(f"LLMAgent '{self.name}' generated {total_pages} valid replacement texts.")
+            print(f"LLMAgent '{self.name}' generated {len(valid_completions)} valid replacement texts.")
 
         except Exception as e:
             print(f"Error in LLMAgent '{self.name}': {e}")
@@ -154,9 +483,7 @@ class LLMAgent:
         Returns:
             tuple: (guild_id, channel_id, message_id) or None if invalid
         """
-        import re
-        pattern = r'https?://(?:www\.)?discord\.com/channels/(\d+)/(\d+)/(\d+)'
-        match = re.match(pattern, url.strip())
+        match = _MESSAGE_URL_RE.match(url.strip())
         if match:
             return int(match.group(1)), int(match.group(2)), int(match.group(3))
         return None
@@ -173,17 +500,49 @@ class LLMAgent:
         Returns:
             str or None: The message URL if this is a history branch, None otherwise
         """
-        if not content.strip().startswith('.history'):
+        if not content.lstrip().startswith('.history'):
             return None
         
         # Look for "last:" followed by a Discord message URL
-        import re
-        pattern = r'last:\s*(https?://(?:www\.)?discord\.com/channels/\d+/\d+/\d+)'
-        match = re.search(pattern, content)
+        match = _BRANCH_LAST_RE.search(content)
         if match:
             return match.group(1)
         return None
 
+    def _remember_completions(self, user_id, entry):
+        """
+        Records a user's completions and evicts users who have been idle past the TTL,
+        or the least recently active ones once more than `message_history_max_users` are kept.
+
+        Args:
+            user_id (int): The ID of the user who triggered the generation.
+            entry (dict): The generating message ID and its completions.
+        """
+        now = time.monotonic()
+        history = self.message_history
+        _, recent = history.pop(user_id, (None, None))
+        if recent is None:
+            recent = _RecentCompletions()
+        recent.append(entry)
+        history[user_id] = (now, recent)
+
+        while history:
+            last_active, _ = next(iter(history.values()))
+            if now - last_active < self.message_history_ttl and len(history) <= self.message_history_max_users:
+                break
+            history.popitem(last=False)
+
+    async def _fetch_history(self, channel, limit, before):
+        """
+        Fetch channel history newest first, from the shared history cache when available.
+
+        Returns:
+            list[discord.Message]: Up to `limit` messages older than `before`.
+        """
+        if self.history_cache is not None:
+            return await self.history_cache.history(channel, limit, before)
+        return [msg async for msg in channel.history(limit=limit, before=before)]
+
     async def _collect_messages_with_branches(self, bot, start_channel, before_message, limit, max_branch_depth=5):
         """
         Collect messages following .history branch markers.
@@ -201,20 +560,26 @@ class LLMAgent:
         Returns:
             list: List of (message, source) tuples in chronological order
         """
-        all_messages = []
+        segments = []  # One chronological deque per channel position visited
         messages_collected = 0
         current_channel = start_channel
         current_before = before_message
+        next_history = None  # History of a branch target, fetched together with the target
         branch_depth = 0
         
         while messages_collected < limit and branch_depth <= max_branch_depth:
             print(f"[DEBUG] Collecting from channel {current_channel.id}, depth={branch_depth}, collected={messages_collected}")
             
             branch_found = False
-            batch_messages = []
+            batch_messages = deque()  # History arrives newest first; appendleft keeps it chronological
+            source = 'thread' if hasattr(current_channel, 'parent_id') and current_channel.parent_id else 'channel'
             
             # Collect messages from current position
-            async for msg in current_channel.history(limit=limit - messages_collected, before=current_before):
+            if next_history is not None:
+                history, next_history = next_history, None
+            else:
+                history = await self._fetch_history(current_channel, limit - messages_collected, current_before)
+            for msg in history:
                 content = msg.content.strip()
                 
                 # Check if this is a .history branch marker
@@ -231,12 +596,18 @@ class LLMAgent:
                         target_channel = bot.get_channel(channel_id)
                         if target_channel:
                             try:
-                                # Fetch the specific message to use as "before" reference
-                                target_message = await target_channel.fetch_message(message_id)
+                                # The target message only bounds the history, so fetch the
+                                # history before it while checking that the message exists
+                                target_message, target_history = await asyncio.gather(
+                                    target_channel.fetch_message(message_id),
+                                    self._fetch_history(target_channel, limit - messages_collected - len(batch_messages),
+                                                        discord.Object(id=message_id))
+                                )
                                 
                                 # Add collected messages so far (before the branch)
-                                all_messages.extend(batch_messages)
+                                segments.append(batch_messages)
                                 messages_collected += len(batch_messages)
+                                next_history = target_history
                                 
                                 # Jump to the new location
                                 current_channel = target_channel
@@ -253,20 +624,22 @@ class LLMAgent:
                         print(f"[DEBUG] Failed to parse branch URL: {branch_url}")
                 
                 # Regular message - add to batch
-                source = 'thread' if hasattr(current_channel, 'parent_id') and current_channel.parent_id else 'channel'
-                batch_messages.append((msg, source))
+                batch_messages.appendleft((msg, source))
             
             if not branch_found:
                 # No more branches, add remaining messages and exit
-                all_messages.extend(batch_messages)
+                segments.append(batch_messages)
                 messages_collected += len(batch_messages)
                 break
         
         if branch_depth > max_branch_depth:
             print(f"[DEBUG] Warning: Hit max branch depth of {max_branch_depth}")
         
-        # Sort all messages by timestamp (oldest first for context)
-        all_messages.sort(key=lambda x: x[0].created_at)
+        # Each segment is already oldest first; merge them by timestamp (branches may jump forward in time)
+        if len(segments) == 1:
+            all_messages = list(segments[0])
+        else:
+            all_messages = list(heapq.merge(*segments, key=lambda x: x[0].created_at))
         
         print(f"[DEBUG] Total messages collected across {branch_depth} branches: {len(all_messages)}")
         return all_messages
@@ -285,10 +658,22 @@ class LLMAgent:
             bot (discord.Client, optional): The bot instance.
 
         Returns:
-            str: Formatted string.
+            tuple[str, list[str]]: The formatted history, and a "name:" stop sequence for
+            each speaker in it.
         """
         channel = message.channel if isinstance(message, discord.Message) else bot.get_channel(message.channel_id)
-        formatted = []
+
+        # Regenerations re-format the history before the same trigger message; reuse a
+        # recent result (interactions read the latest history, which keeps moving)
+        cache_key = (channel.id, message.id) if isinstance(message, discord.Message) else None
+        if cache_key is not None:
+            cached = self._prompt_cache.get(cache_key)
+            if cached is not None and time.monotonic() - cached[0] < self._prompt_cache_ttl:
+                print(f"[DEBUG] Reusing formatted history for message {message.id}")
+                return cached[1]
+
+        formatted = deque()
+        speakers = {}  # Author names of the formatted lines, in order of appearance
         all_messages = []
         
         try:
@@ -305,431 +690,606 @@ class LLMAgent:
             
             print(f"[DEBUG] Total messages collected: {len(all_messages)}")
             
-            # Process messages
+            # Format the messages that are new or edited since earlier prompts; a large batch
+            # (such as the first prompt in a channel) runs in a worker thread instead of
+            # blocking the requests in flight on the event loop
+            line_cache = self._line_cache
+            entries = {}  # Format: {message_id: (content, line)} for this history
+            pending = []
             for msg, source in all_messages:
-                # Skip bot messages if desired
-                # if msg.author.bot:
-                #    continue
-                
-                # Get clean username without any square bracket content
-                # Use actual username (.name) for consistent LLM identification
-                username = msg.author.name
-                username = self._clean_username(username)
-
-                # Clean up content if it contains oblique tags
-                content = msg.content
-                if "[oblique:" in content:
-                    content = content.split("[oblique:")[0].strip()
-                content = content.replace("[oblique]", "").strip()
-
-                # Convert mentions to readable format
-                for mention in msg.mentions:
-                    content = content.replace(f'<@{mention.id}>', f'@{mention.display_name}')
-                    content = content.replace(f'<@!{mention.id}>', f'@{mention.display_name}')  # Handle mentions with !
-                for role_mention in msg.role_mentions:
-                    content = content.replace(f'<@&{role_mention.id}>', f'@{role_mention.name}')
-                if msg.mention_everyone:
-                    content = content.replace('@everyone', '@everyone')
-                    content = content.replace('@here', '@here')
-
-                if content == "oblique_clear":
-                    print("clearing")
-                    break
+                cached = line_cache.get(msg.id)
+                if cached is None or cached[0] != msg.content:
+                    pending.append(msg)
+                else:
+                    entries[msg.id] = cached
+            if pending:
+                if len(pending) >= self._thread_format_min:
+                    lines = await asyncio.to_thread(self._format_message_lines, pending)
+                else:
+                    lines = self._format_message_lines(pending)
+                for msg, line in zip(pending, lines):
+                    entries[msg.id] = (msg.content, line)
 
-                # Strip HTML content
-                try:
-                    soup = BeautifulSoup(content, "html.parser")
-                    clean_content = soup.get_text()
-                except Exception as e:
-                    clean_content = content
+            # Assemble from the local entries: the shared cache can be trimmed, here or by a
+            # concurrent call during the thread hop, before this history is read back
+            append = formatted.append
+            for msg, source in all_messages:
+                line = entries[msg.id][1]
 
-                if clean_content.startswith(".") or clean_content == "Oblique: Generating..." or clean_content == "Regenerating...":
-                    continue
-                
-                # Use colon format for all models
-                formatted.append(f'{username}: {clean_content}\n')
+                if line is _CLEAR_MARKER:
+                    print("clearing")
+                    break
+                if line:
+                    append(line)
+                    speakers[msg.author.name] = None
+
+            # Only now store the new lines and mark this history as recently used, then evict
+            for message_id, entry in entries.items():
+                line_cache[message_id] = entry
+                line_cache.move_to_end(message_id)
+            while len(line_cache) > self._line_cache_size:
+                line_cache.popitem(last=False)
                     
         except Exception as e:
             print(f"Error formatting messages: {e}")
-            
-        return "".join(formatted)
+            return "".join(formatted), self._stop_sequences(speakers)
+
+        result = "".join(formatted), self._stop_sequences(speakers)
+        if cache_key is not None:
+            self._prompt_cache[cache_key] = (time.monotonic(), result)
+            self._prompt_cache.move_to_end(cache_key)
+            while len(self._prompt_cache) > 64:
+                self._prompt_cache.popitem(last=False)
+        return result
+
+    def _format_message_lines(self, messages):
+        """Formats a batch of history messages; safe to run in a worker thread."""
+        return [self._format_message_line(msg) for msg in messages]
+
+    @staticmethod
+    def _is_skipped_content(content):
+        """Whether a message is a command or bot status that stays out of the prompt."""
+        return content.startswith(".") or content == "Oblique: Generating..." or content == "Regenerating..."
 
-    async def send_completion_request_with_n(self, prompt, max_tokens, temperature, formatted_messages, mode='self', n=3):
+    def _format_message_line(self, msg):
         """
-        Sends a single completion request with n parameter for multiple completions.
+        Formats a single history message as a prompt line.
+
+        Args:
+            msg (discord.Message): The message to format.
+
+        Returns:
+            str or None: The line including its trailing newline, None if the message
+            should be left out, or _CLEAR_MARKER for an oblique_clear message.
+        """
+        # Skip bot messages if desired
+        # if msg.author.bot:
+        #    return None
+
+        # Clean up content if it contains oblique tags: drop everything from the first
+        # "[oblique:" on, then any bare "[oblique]" tags
+        content = msg.content.partition("[oblique:")[0]
+        if "[oblique]" in content:
+            content = content.replace("[oblique]", "")
+        content = content.strip()
+
+        # Control messages are settled by cheap checks before any mention or HTML work
+        if content == "oblique_clear":
+            return _CLEAR_MARKER
+        if self._is_skipped_content(content):
+            return None
+
+        # Convert mentions to readable format in one pass (@everyone/@here are already readable)
+        if (msg.mentions or msg.role_mentions) and '<@' in content:
+            users = {str(mention.id): mention.display_name for mention in msg.mentions}
+            roles = {str(role_mention.id): role_mention.name for role_mention in msg.role_mentions}
+
+            def readable(match):
+                name = (roles if match.group(1) == '&' else users).get(match.group(2))
+                return f'@{name}' if name is not None else match.group(0)
+
+            content = _MENTION_RE.sub(readable, content)
+
+        # Strip HTML content (most messages have none, so avoid building a parser for them)
+        if _has_html(content):
+            clean_content = _html_to_text(content)
+            # The visible text can still turn out to be a control message
+            if self._is_skipped_content(clean_content):
+                return None
+        else:
+            clean_content = content
+
+        # Get clean username without any square bracket content
+        # Use actual username (.name) for consistent LLM identification
+        username = self._clean_username(msg.author.name)
+
+        # Use colon format for all models
+        return f'{username}: {clean_content}\n'
+
+    async def _gather_completions(self, requests):
+        """
+        Runs completion requests concurrently, letting each finish even if another fails.
+
+        Args:
+            requests (list): Coroutines that each return a completion string.
+
+        Returns:
+            list[str]: The completions in request order, with "" for any that raised.
+        """
+        tasks = [_start_task(request) for request in requests]
+        if not tasks:
+            return []
+        try:
+            await asyncio.wait(tasks)
+        finally:
+            # Only does anything if we were cancelled while waiting
+            for task in tasks:
+                task.cancel()
+        completions = []
+        for task in tasks:
+            if task.cancelled() or task.exception() is not None:
+                print(f"Completion request failed: {'cancelled' if task.cancelled() else repr(task.exception())}")
+                completions.append("")
+            else:
+                completions.append(task.result())
+        return completions
+
+    async def _read_stream(self, resp, on_choice=None, on_progress=None):
+        """
+        Reads a server-sent events completion stream.
+
+        Args:
+            resp (aiohttp.ClientResponse): A successful response to a request with "stream": true.
+            on_choice (callable, optional): Awaited with (choice_index, text) as soon as a
+                choice finishes, while the other choices are still streaming.
+            on_progress (callable, optional): Awaited with (choice_index, text so far) when a
+                choice's first text arrives, then at most every _preview_interval seconds.
+
+        Returns:
+            dict: The response in the same shape as a non-streamed one, with the text of
+            each choice joined back together (plus "usage" and "error" when sent).
+        """
+        is_chat = self._is_instruct
+        texts = {}  # Format: {choice_index: [text pieces]}
+        finish_reasons = {}
+        progress_due = {}  # Format: {choice_index: monotonic time of the next on_progress call}
+        data = {}
+        async for raw_line in resp.content:
+            line = raw_line.strip()
+            if not line.startswith(b"data:"):
+                continue  # Blank event separators and ": keep-alive" comments
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                break
+            event = _json_loads(payload)
+            if 'error' in event:
+                data['error'] = event['error']
+                break
+            if event.get('usage'):
+                data['usage'] = event['usage']
+            for choice in event.get('choices') or ():
+                index = choice.get('index', 0)
+                piece = (choice.get('delta') or {}).get('content') if is_chat else choice.get('text')
+                if piece:
+                    texts.setdefault(index, []).append(piece)
+                    if on_progress is not None and index not in finish_reasons:
+                        now = time.monotonic()
+                        if now >= progress_due.get(index, 0):
+                            progress_due[index] = now + self._preview_interval
+                            await on_progress(index, "".join(texts[index]))
+                if choice.get('finish_reason') and index not in finish_reasons:
+                    finish_reasons[index] = choice['finish_reason']
+                    if on_choice is not None:
+                        await on_choice(index, "".join(texts.get(index, ())))
+
+        choices = []
+        for index in sorted(texts.keys() | finish_reasons.keys()):
+            text = "".join(texts.get(index, ()))
+            choice = {"index": index, "finish_reason": finish_reasons.get(index)}
+            if is_chat:
+                choice["message"] = {"role": "assistant", "content": text}
+            else:
+                choice["text"] = text
+            choices.append(choice)
+        data['choices'] = choices
+        return data
+
+    async def _read_response(self, resp, on_choice=None, on_progress=None):
+        """
+        Reads a response body once, decoding it to text only when it has to be logged.
+
+        Args:
+            resp (aiohttp.ClientResponse): The API response.
+            on_choice (callable, optional): Passed to _read_stream for streamed responses.
+            on_progress (callable, optional): Passed to _read_stream for streamed responses.
+
+        Returns:
+            tuple: (data, text) where data is the parsed JSON of a successful response
+            and text is None, or data is None and text is the body of an error status
+            or of a body that is not valid JSON.
+        """
+        if resp.status == 200 and self._stream:
+            return await self._read_stream(resp, on_choice, on_progress), None
+        body = await resp.read()
+        if resp.status == 200:
+            try:
+                return _json_loads(body), None
+            except ValueError:
+                pass
+        # Decode directly rather than through resp.text(), which may run charset detection
+        return None, body.decode('utf-8', 'replace')
+
+    def _retry_delay(self, attempt, retry_after=None):
+        """
+        Exponential backoff with full jitter, so concurrent requests that failed
+        together don't all retry at the same moment.
+
+        Args:
+            attempt (int): Zero-based index of the attempt that just failed.
+            retry_after (float, optional): Delay requested by the provider's Retry-After header.
+
+        Returns:
+            float: Seconds to wait before the next attempt.
+        """
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _build_request(self, prompt, max_tokens, temperature, stop_sequences, mode, n=None):
+        """
+        Builds the payload for a completion request and serializes it once, so retries
+        resend the same bytes.
+
+        The separate requests made for one prompt are identical, so the last request is
+        memoized: they share one payload and JSON encoding.
 
         Args:
             prompt (str): The formatted prompt including any seed text.
             max_tokens (int): The maximum number of tokens for the response.
             temperature (float): The temperature for generation.
-            formatted_messages (str): The formatted chat history for extracting stop sequences
+            stop_sequences (list[str]): The "name:" stop sequences from format_messages
             mode (str): Generation mode - 'self' (stop at other users) or 'full' (generate full exchange)
-            n (int): Number of completions to generate.
+            n (int, optional): Number of completions to request in one call.
 
         Returns:
-            list[str]: List of response texts from the LLM.
+            tuple[dict, bytes]: The payload and its JSON encoding.
         """
-        print(f"[DEBUG] Starting send_completion_request_with_n with n={n}")
-        print(f"[DEBUG] Model: {self.model_config.get('model_id')}")
-        print(f"[DEBUG] Endpoint: {self.model_config.get('endpoint')}")
-        print(f"[DEBUG] Prompt length: {len(prompt)}")
-        
-        # Create log file name with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-        # Sanitize agent name for filesystem by replacing unsafe characters
-        safe_name = self.name.replace("/", "_").replace("\\", "_").replace(":", "_")
-        log_file = os.path.join(self.log_dir, f"{safe_name}_{timestamp}.log")
-
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self._get_api_key()}",
-            "Accept-Encoding": "identity",  # Avoid gzip issues with some servers
-            "X-Title": "Oblique"
-        }
-
-        if temperature is None:
-            temperature = 1
+        key = (prompt, max_tokens, temperature, tuple(stop_sequences or ()), mode, n)
+        if self._last_request is not None and self._last_request[0] == key:
+            return self._last_request[1], self._last_request[2]
 
         # Choose API format based on model type
-        if self.model_config.get('type') == 'instruct':
+        if self._is_instruct:
             # Use chat API with prefill for instruct models
             payload = {
-                "model": self.model_config.get('model_id'),
+                **self._payload_base,
                 "messages": [
-                    {"role": "system", "content": self.model_config.get('system_prompt', '')},
-                    {"role": "user", "content": self.model_config.get('user_prefix', '')},
+                    *self._chat_prefix,
                     {"role": "assistant", "content": prompt}  # Prefill with the entire chat history + seed
                 ],
                 "max_tokens": max_tokens,
-                "temperature": temperature,
-                "n": n
+                "temperature": temperature
             }
-            
-            # Add stop sequences for instruct models only in 'self' mode
-            # In 'full' mode, we want the model to generate a full multi-user exchange
-            if mode == 'self':
-                stop_sequences = self._extract_usernames_from_messages(formatted_messages)
-                if stop_sequences:
-                    payload["stop"] = stop_sequences
-                    print(f"[DEBUG] Added stop sequences (mode=self): {stop_sequences}")
-            else:
-                print(f"[DEBUG] Skipping stop sequences (mode={mode}) to allow full exchange generation")
-            
-            # Add provider settings if quantization is specified
-            if self.model_config.get('quantization'):
-                payload["provider"] = {
-                    "quantizations": [self.model_config.get('quantization')]
-                }
-                
-            endpoint = self.model_config.get('endpoint', '').rstrip('/')
         else:
             # Use completions API for base models
             payload = {
-                "model": self.model_config.get('model_id'),
+                **self._payload_base,
                 "prompt": prompt,
                 "max_tokens": max_tokens,
-                "temperature": temperature,
-                "n": n
+                "temperature": temperature
             }
-            
-            # Add stop sequences for base models in 'self' mode
-            # In 'full' mode, we want the model to generate a full multi-user exchange
-            if mode == 'self':
-                stop_sequences = self._extract_usernames_from_messages(formatted_messages)
-                if stop_sequences:
-                    payload["stop"] = stop_sequences
-                    print(f"[DEBUG] Added stop sequences for base model (mode=self): {stop_sequences}")
-            else:
-                print(f"[DEBUG] Skipping stop sequences for base model (mode={mode})")
-            
-            # Add provider settings if quantization is specified
-            if self.model_config.get('quantization'):
-                payload["provider"] = {
-                    "quantizations": [self.model_config.get('quantization')]
-                }
-                
-            endpoint = self.model_config.get('endpoint', '').rstrip('/')
+        if n is not None:
+            payload["n"] = n
+
+        # Add stop sequences only in 'self' mode
+        # In 'full' mode, we want the model to generate a full multi-user exchange
+        if mode == 'self':
+            if stop_sequences:
+                payload["stop"] = list(stop_sequences)
+                print(f"[DEBUG] Added stop sequences (mode=self): {stop_sequences}")
+        else:
+            print(f"[DEBUG] Skipping stop sequences (mode={mode}) to allow full exchange generation")
 
-        # Log the request
-        with open(log_file, "w", encoding="utf-8") as f:
-            f.write("=== REQUEST ===\n")
-            f.write(f"Timestamp: {timestamp}\n")
-            f.write(f"Model Type: {self.model_config.get('type')}\n")
-            f.write(f"Model: {self.model_config.get('model_id')}\n")
-            f.write(f"Temperature: {temperature}\n")
-            f.write(f"Max Tokens: {max_tokens}\n")
-            f.write(f"N: {n}\n")
-            f.write(f"Mode: {mode}\n")
-            f.write(f"Endpoint: {endpoint}\n")
-            if self.model_config.get('type') == 'instruct':
-                f.write("=== MESSAGES ===\n")
-                for msg in payload["messages"]:
-                    f.write(f"{msg['role']}: {msg['content']}\n")
-            if "stop" in payload:
-                f.write(f"=== STOP SEQUENCES ===\n")
-                f.write(f"{payload['stop']}\n")
-            if self.model_config.get('type') != 'instruct':
-                f.write("=== PROMPT ===\n")
-                f.write(prompt)
-            f.write("\n")
+        request_body = _json_dumps(payload)
+        self._last_request = (key, payload, request_body)
+        return payload, request_body
 
-        print(f"Sending LLM request with n={n}, model_type: {self.model_config.get('type')}, model: {self.model_config.get('model_id')}, length: {len(prompt)}, max_tokens: {max_tokens}, temperature: {temperature}, mode: {mode}")
-        
-        # Debug the payload before sending
-        print(f"[DEBUG] Request payload: {json.dumps(payload, indent=2)}")
+    def _request_log_header(self, timestamp, payload, prompt, mode, n=None):
+        """
+        Builds the request section of a request log in one string.
+
+        Args:
+            timestamp (int): The request timestamp used in the log file name.
+            payload (dict): The request payload.
+            prompt (str): The prompt, logged for completion (base) models.
+            mode (str): The generation mode.
+            n (int, optional): Completions requested in one call, if the n parameter is used.
+
+        Returns:
+            str: The request section, ending with a blank line.
+        """
+        parts = [
+            "=== REQUEST ===\n"
+            f"Timestamp: {timestamp}\n"
+            f"Model Type: {self.model_config.get('type')}\n"
+            f"Model: {self.model_config.get('model_id')}\n"
+            f"Temperature: {payload['temperature']}\n"
+            f"Max Tokens: {payload['max_tokens']}\n"
+        ]
+        if n is not None:
+            parts.append(f"N: {n}\n")
+        parts.append(f"Mode: {mode}\nEndpoint: {self._endpoint}\n")
+        if self._is_instruct:
+            parts.append("=== MESSAGES ===\n")
+            parts.extend(f"{msg['role']}: {msg['content']}\n" for msg in payload["messages"])
+        if "stop" in payload:
+            parts.append(f"=== STOP SEQUENCES ===\n{payload['stop']}\n")
+        if not self._is_instruct:
+            parts.append(f"=== PROMPT ===\n{prompt}")
+        parts.append("\n")
+        return "".join(parts)
+
+    async def _send(self, request_body, log_lines, on_choice=None, streamed_early=None, on_progress=None):
+        """
+        Posts a completion request, retrying rate limits, overloads and connection errors
+        with backoff.
 
-        for _ in range(10):
+        Args:
+            request_body (bytes): The JSON-encoded payload.
+            log_lines (list[str]): The request log record; the response section is appended.
+            on_choice (callable, optional): Passed to _read_response for streamed responses.
+            streamed_early (dict, optional): Filled by on_choice with {choice_index: text}
+                for choices delivered while the stream was open.
+            on_progress (callable, optional): Passed to _read_response for streamed responses.
+
+        Returns:
+            tuple: (status, choices). status is the HTTP status of the last response, or None
+            if no response was read in full (connection errors, a broken stream). choices is
+            a list of (choice index, text) for each choice of the response, or None if the
+            request failed; if the stream broke after some choices were delivered, those
+            choices are returned.
+        """
+        streamed_early = streamed_early if streamed_early is not None else {}
+        retry_delay = 0
+        retry_waited = 0.0
+        for attempt in range(10):
+            if retry_delay:
+                if retry_waited + retry_delay > self.max_retry_wait:
+                    print(f"Giving up after {retry_waited:.1f}s of retry backoff.")
+                    return None, None
+                retry_waited += retry_delay
+                await asyncio.sleep(retry_delay)
             try:
-                print(f"[DEBUG] Attempting API request to {endpoint}")
                 async with self.rate_limit:
-                    async with self.session.post(endpoint, json=payload,
-                                                 headers=headers) as resp:
-                        print(f"[DEBUG] Received response with status {resp.status}")
-                        response_text = await resp.text()
-                        print(f"[DEBUG] Response text length: {len(response_text)}")
-                        
-                        # Log the raw response
-                        with open(log_file, "a", encoding="utf-8") as f:
-                            f.write("\n=== RESPONSE ===\n")
-                            f.write(f"Status: {resp.status}\n")
-                            f.write(response_text)
-                            f.write("\n")
+                    request_started = time.monotonic()
+                    async with self.session.post(self._endpoint, data=request_body) as resp:
+                        retry_after = self.rate_limit.update_from_headers(resp.headers)
+                        data, response_text = await self._read_response(resp, on_choice, on_progress)
+                        await self.rate_limit.record_result(resp.status, time.monotonic() - request_started)
+
+                        # Log the raw body of failed responses; successful ones are logged as extracted results
+                        if response_text is not None:
+                            log_lines.append(f"\n=== RESPONSE ===\nStatus: {resp.status}\n{response_text}\n")
+                        else:
+                            log_lines.append(f"\n=== RESPONSE ===\nStatus: {resp.status}\nUsage: {data.get('usage')}\n")
+
+                        if resp.status in BACKOFF_STATUSES:
+                            # Rate limited or provider overloaded: transient, so back off and retry
+                            retry_delay = self._retry_delay(attempt, retry_after)
+                            print(f"API returned status {resp.status}. Retrying in {retry_delay:.2f} seconds...")
+                            continue
 
                         if resp.status != 200:
                             print(f"API returned status {resp.status}: {response_text}")
-                            return [""] * n  # Return empty strings for all expected completions
-                        
-                        data = await resp.json()
-                        print(f"[DEBUG] Parsed JSON response, processing {len(data.get('choices', []))} choices")
-                        
+                            return resp.status, None
+
+                        if data is None:
+                            print(f"Could not parse API response: {response_text[:200]}")
+                            return resp.status, None
+
                         # Show just the structure we care about - choices count and basic info
                         choices = data.get("choices", [])
                         print(f"[DEBUG] Response has {len(choices)} choices:")
                         for i, choice in enumerate(choices):
-                            content_length = len(choice.get("message", {}).get("content", choice.get("text", "")[-1000:]))
+                            content_length = len(choice.get("message", {}).get("content", choice.get("text", "")))
                             finish_reason = choice.get("finish_reason", "unknown")
                             print(f"[DEBUG]   Choice {i+1}: {content_length} chars, finish_reason: {finish_reason}")
-                        
+
                         if 'error' in data:
                             print(f"API returned error: {data['error']}")
-                            if data['error'].get('code') == 429:
-                                print("Rate limit hit. Retrying in 1 second...")
-                                await asyncio.sleep(1)
+                            # A retry would repeat completions that were already delivered
+                            if data['error'].get('code') == 429 and not streamed_early:
+                                retry_delay = self._retry_delay(attempt, retry_after)
+                                print(f"Rate limit hit. Retrying in {retry_delay:.2f} seconds...")
                                 continue
-                            return [""] * n
-                        
-                        # Extract all results based on API type
-                        results = []
-                        for i, choice in enumerate(choices):
-                            if self.model_config.get('type') == 'instruct':
-                                # Chat API response format
-                                result = choice.get("message", {}).get("content", "")
-                            else:
-                                # Completions API response format
-                                result = choice.get("text", "")
-                            results.append(result)
-                            print(f"[DEBUG] Choice {i+1}: {len(result)} characters")
-                        
-                        # Ensure we return the expected number of results
-                        while len(results) < n:
-                            results.append("")
-                            print(f"[DEBUG] Added empty result to reach n={n}")
-                        
-                        print(f"[DEBUG] Returning {len(results)} results")
-                        
-                        # Log the extracted results
-                        with open(log_file, "a", encoding="utf-8") as f:
-                            f.write("\n=== EXTRACTED RESULTS ===\n")
-                            for i, result in enumerate(results):
-                                f.write(f"Result {i+1}: {result}\n")
-                            f.write("\n")
-                            
-                        return results[:n]  # Return exactly n results
+                            return resp.status, None
+
+                        self.rate_limit.record_usage((data.get('usage') or {}).get('total_tokens'))
+
+                        # Extract the text of each choice based on API type
+                        if self._is_instruct:
+                            # Chat API response format
+                            return resp.status, [(choice.get('index', i), choice.get("message", {}).get("content", ""))
+                                                 for i, choice in enumerate(choices)]
+                        # Completions API response format
+                        return resp.status, [(choice.get('index', i), choice.get("text", "")) for i, choice in enumerate(choices)]
             except aiohttp.ClientError as e:
-                print(f"HTTP Client Error: {e}. Retrying in 5 seconds...")
-                await asyncio.sleep(5)
+                if streamed_early:
+                    # The stream broke after some choices were delivered; keep those rather
+                    # than retrying (which would repeat them)
+                    print(f"HTTP Client Error after {len(streamed_early)} streamed choices: {e}")
+                    return None, list(streamed_early.items())
+                retry_delay = self._retry_delay(attempt)
+                print(f"HTTP Client Error: {e}. Retrying in {retry_delay:.2f} seconds...")
             except asyncio.CancelledError:
                 raise
             except Exception as e:
                 print(f"Error sending completion request: {e}")
-                return [""] * n
+                return None, None
         print("Failed to send completion request after 10 retries.")
-        return [""] * n
+        return None, None
 
-    async def send_completion_request(self, prompt, max_tokens, temperature, formatted_messages, mode='self'):
+    async def send_completion_request_with_n(self, prompt, max_tokens, temperature, stop_sequences, mode='self', n=3,
+                                             on_completion=None, probe=False, on_progress=None):
         """
-        Sends the prompt to the completion or chat endpoint based on model type.
+        Sends a single completion request with n parameter for multiple completions.
 
         Args:
             prompt (str): The formatted prompt including any seed text.
             max_tokens (int): The maximum number of tokens for the response.
             temperature (float): The temperature for generation.
-            formatted_messages (str): The formatted chat history for extracting stop sequences
+            stop_sequences (list[str]): The "name:" stop sequences from format_messages
             mode (str): Generation mode - 'self' (stop at other users) or 'full' (generate full exchange)
+            n (int): Number of completions to generate.
+            on_completion (callable, optional): Awaited once with each completion's text, one
+                at a time. When streaming, a choice is handed over as soon as it finishes instead
+                of after the slowest one.
+            probe (bool): Whether this request tests an endpoint not known to support n. The
+                outcome is stored as the model's supports_n_parameter.
+            on_progress (callable, optional): Awaited with (choice_index, text so far) while
+                a streamed choice is still being generated.
 
         Returns:
-            str: The response text from the LLM.
+            list[str]: List of response texts from the LLM.
         """
-        # Create log file name with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-        # Sanitize agent name for filesystem by replacing unsafe characters
-        safe_name = self.name.replace("/", "_").replace("\\", "_").replace(":", "_")
-        log_file = os.path.join(self.log_dir, f"{safe_name}_{timestamp}.log")
-
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self._get_api_key()}",
-            "Accept-Encoding": "identity",  # Avoid gzip issues with some servers
-            "X-Title": "Oblique"
-        }
+        # Create log file name with timestamp (nanoseconds since the epoch)
+        timestamp = time.time_ns()
+        log_file = f"{self._log_prefix}{timestamp}.log"
 
         if temperature is None:
             temperature = 1
 
-        # Choose API format based on model type
-        if self.model_config.get('type') == 'instruct':
-            # Use chat API with prefill for instruct models
-            payload = {
-                "model": self.model_config.get('model_id'),
-                "messages": [
-                    {"role": "system", "content": self.model_config.get('system_prompt', '')},
-                    {"role": "user", "content": self.model_config.get('user_prefix', '')},
-                    {"role": "assistant", "content": prompt}  # Prefill with the entire chat history + seed
-                ],
-                "max_tokens": max_tokens,
-                "temperature": temperature
-            }
-            
-            # Add stop sequences for instruct models only in 'self' mode
-            # In 'full' mode, we want the model to generate a full multi-user exchange
-            if mode == 'self':
-                stop_sequences = self._extract_usernames_from_messages(formatted_messages)
-                if stop_sequences:
-                    payload["stop"] = stop_sequences
-                    print(f"[DEBUG] Added stop sequences (mode=self): {stop_sequences}")
+        payload, request_body = self._build_request(prompt, max_tokens, temperature, stop_sequences, mode, n=n)
+
+        # Log the request
+        log_lines = [self._request_log_header(timestamp, payload, prompt, mode, n)]
+
+        print(f"Sending LLM request with n={n}, model_type: {self.model_config.get('type')}, model: {self.model_config.get('model_id')}, length: {len(prompt)}, max_tokens: {max_tokens}, temperature: {temperature}, mode: {mode}")
+        # The full request goes to the log file; printing the pretty-printed payload here
+        # would block the event loop on a console write of the whole prompt
+        print(f"[DEBUG] Request will be logged to {log_file}")
+
+        streamed_early = {}  # Format: {choice_index: text} delivered while the stream was open
+        on_choice = None
+        delivery = None
+        if on_completion is not None and self._stream:
+            # Choices that finish mid-stream are handed over by a separate task, so the stream
+            # (and the rate limiter slot it holds) never waits on the Discord edits they trigger
+            finished = asyncio.Queue()
+
+            async def deliver_finished():
+                while (text := await finished.get()) is not None:
+                    await on_completion(text)
+
+            async def on_choice(index, text):
+                streamed_early[index] = text
+                finished.put_nowait(text)
+
+            delivery = asyncio.create_task(deliver_finished())
+
+        try:
+            status, choices = await self._send(request_body, log_lines, on_choice, streamed_early, on_progress)
+            if delivery is not None:
+                # Let the streamed choices reach on_completion before any remaining ones
+                finished.put_nowait(None)
+                await delivery
+            if choices is not None:
+                # Log the extracted results
+                extracted = "".join(f"Result {i+1}: {text}\n" for i, (_, text) in enumerate(choices))
+                log_lines.append(f"\n=== EXTRACTED RESULTS ===\n{extracted}\n")
+        finally:
+            if delivery is not None:
+                # Only does anything if we were cancelled before the deliveries finished
+                delivery.cancel()
+            # Write the whole request/response record with a single append
+            self._log(log_file, "".join(log_lines))
+
+        if probe:
+            # Only a complete answer settles it: several choices mean n works, while a single
+            # choice or a client error (the request itself was refused) means it does not.
+            # Timeouts, overloads and broken streams say nothing about n, so the next request
+            # probes again. The model config is shared by every agent of this model
+            if status == 200 and choices:
+                supported = len(choices) > 1
+            elif choices is None and status is not None and 400 <= status < 500 and status not in BACKOFF_STATUSES:
+                supported = False
             else:
-                print(f"[DEBUG] Skipping stop sequences (mode={mode}) to allow full exchange generation")
-            
-            # Add provider settings if quantization is specified
-            if self.model_config.get('quantization'):
-                payload["provider"] = {
-                    "quantizations": [self.model_config.get('quantization')]
-                }
-                
-            endpoint = self.model_config.get('endpoint', '').rstrip('/')
-        else:
-            # Use completions API for base models
-            payload = {
-                "model": self.model_config.get('model_id'),
-                "prompt": prompt,
-                "max_tokens": max_tokens,
-                "temperature": temperature
-            }
-            
-            # Add stop sequences for base models in 'self' mode
-            # In 'full' mode, we want the model to generate a full multi-user exchange
-            if mode == 'self':
-                stop_sequences = self._extract_usernames_from_messages(formatted_messages)
-                if stop_sequences:
-                    payload["stop"] = stop_sequences
-                    print(f"[DEBUG] Added stop sequences for base model (mode=self): {stop_sequences}")
+                supported = None
+            if supported is not None:
+                self.model_config['supports_n_parameter'] = supported
+                print(f"[DEBUG] Model {self.model_config.get('model_id')} {'supports' if supported else 'does not support'} the n parameter")
             else:
-                print(f"[DEBUG] Skipping stop sequences for base model (mode={mode})")
-            
-            # Add provider settings if quantization is specified
-            if self.model_config.get('quantization'):
-                payload["provider"] = {
-                    "quantizations": [self.model_config.get('quantization')]
-                }
-                
-            endpoint = self.model_config.get('endpoint', '').rstrip('/')
+                print(f"[DEBUG] n parameter probe for {self.model_config.get('model_id')} was inconclusive, will probe again")
+
+        if choices is None:
+            return list(streamed_early.values()) + [""] * (n - len(streamed_early))
+        results = [text for _, text in choices]
+        undelivered = [text for index, text in choices if index not in streamed_early]  # Not yet handed to on_completion
+
+        # Some providers silently ignore n and return a single choice; request the
+        # missing completions individually (outside the rate limiter slot held above)
+        missing = n - len(results)
+        if results and missing > 0:
+            print(f"[DEBUG] Provider returned {len(results)} of {n} choices, requesting {missing} more")
+            extra_tasks = [self.send_completion_request(prompt, max_tokens, temperature, stop_sequences, mode=mode) for _ in range(missing)]
+            extra = await self._gather_completions(extra_tasks)
+            results.extend(extra)
+            undelivered.extend(extra)
+
+        if on_completion is not None:
+            for result in undelivered:
+                await on_completion(result)
+
+        # Ensure we return the expected number of results
+        while len(results) < n:
+            results.append("")
+            print(f"[DEBUG] Added empty result to reach n={n}")
+
+        print(f"[DEBUG] Returning {len(results)} results")
+        return results[:n]  # Return exactly n results
+
+    async def send_completion_request(self, prompt, max_tokens, temperature, stop_sequences, mode='self', on_progress=None):
+        """
+        Sends the prompt to the completion or chat endpoint based on model type.
+
+        Args:
+            prompt (str): The formatted prompt including any seed text.
+            max_tokens (int): The maximum number of tokens for the response.
+            temperature (float): The temperature for generation.
+            stop_sequences (list[str]): The "name:" stop sequences from format_messages
+            mode (str): Generation mode - 'self' (stop at other users) or 'full' (generate full exchange)
+            on_progress (callable, optional): Awaited with (choice_index, text so far) while
+                a streamed response is still being generated.
+
+        Returns:
+            str: The response text from the LLM.
+        """
+        # Create log file name with timestamp (nanoseconds since the epoch)
+        timestamp = time.time_ns()
+        log_file = f"{self._log_prefix}{timestamp}.log"
+
+        if temperature is None:
+            temperature = 1
+
+        payload, request_body = self._build_request(prompt, max_tokens, temperature, stop_sequences, mode)
 
         # Log the request
-        with open(log_file, "w", encoding="utf-8") as f:
-            f.write("=== REQUEST ===\n")
-            f.write(f"Timestamp: {timestamp}\n")
-            f.write(f"Model Type: {self.model_config.get('type')}\n")
-            f.write(f"Model: {self.model_config.get('model_id')}\n")
-            f.write(f"Temperature: {temperature}\n")
-            f.write(f"Max Tokens: {max_tokens}\n")
-            f.write(f"Mode: {mode}\n")
-            f.write(f"Endpoint: {endpoint}\n")
-            if self.model_config.get('type') == 'instruct':
-                f.write("=== MESSAGES ===\n")
-                for msg in payload["messages"]:
-                    f.write(f"{msg['role']}: {msg['content']}\n")
-            if "stop" in payload:
-                f.write(f"=== STOP SEQUENCES ===\n")
-                f.write(f"{payload['stop']}\n")
-            if self.model_config.get('type') != 'instruct':
-                f.write("=== PROMPT ===\n")
-                f.write(prompt)
-            f.write("\n")
+        log_lines = [self._request_log_header(timestamp, payload, prompt, mode)]
 
         print(f"Sending LLM request, model_type: {self.model_config.get('type')}, model: {self.model_config.get('model_id')}, length: {len(prompt)}, max_tokens: {max_tokens}, temperature: {temperature}, mode: {mode}")
 
-        for _ in range(10):
-            try:
-                async with self.rate_limit:
-                    async with self.session.post(endpoint, json=payload,
-                                                 headers=headers) as resp:
-                        response_text = await resp.text()
-                        
-                        # Log the raw response
-                        with open(log_file, "a", encoding="utf-8") as f:
-                            f.write("\n=== RESPONSE ===\n")
-                            f.write(f"Status: {resp.status}\n")
-                            f.write(response_text)
-                            f.write("\n")
-
-                        if resp.status != 200:
-                            print(f"API returned status {resp.status}: {response_text}")
-                            return ""
-                        
-                        data = await resp.json()
-                        print(f"[DEBUG] Parsed JSON response, processing {len(data.get('choices', []))} choices")
-                        
-                        # Show just the structure we care about - choices count and basic info
-                        choices = data.get("choices", [])
-                        print(f"[DEBUG] Response has {len(choices)} choices:")
-                        for i, choice in enumerate(choices):
-                            content_length = len(choice.get("message", {}).get("content", choice.get("text", "")))
-                            finish_reason = choice.get("finish_reason", "unknown")
-                            print(f"[DEBUG]   Choice {i+1}: {content_length} chars, finish_reason: {finish_reason}")
-                        
-                        if 'error' in data:
-                            print(f"API returned error: {data['error']}")
-                            if data['error'].get('code') == 429:
-                                print("Rate limit hit. Retrying in 1 second...")
-                                await asyncio.sleep(1)
-                                continue
-                            return ""
-                        
-                        # Extract result based on API type
-                        if self.model_config.get('type') == 'instruct':
-                            # Chat API response format
-                            result = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-                        else:
-                            # Completions API response format
-                            result = data.get("choices", [{}])[0].get("text", "")
-                        
-                        # Log the extracted result
-                        with open(log_file, "a", encoding="utf-8") as f:
-                            f.write("\n=== EXTRACTED RESULT ===\n")
-                            f.write(result)
-                            f.write("\n")
-                            
-                        return result
-            except aiohttp.ClientError as e:
-                print(f"HTTP Client Error: {e}. Retrying in 5 seconds...")
-                await asyncio.sleep(5)
-            except asyncio.CancelledError:
-                raise
-            except Exception as e:
-                print(f"Error sending completion request: {e}")
+        try:
+            _, choices = await self._send(request_body, log_lines, on_progress=on_progress)
+            if not choices:
                 return ""
-        print("Failed to send completion request after 10 retries.")
-        return ""
+            result = choices[0][1]
+            # Log the extracted result
+            log_lines.append(f"\n=== EXTRACTED RESULT ===\n{result}\n")
+            return result
+        finally:
+            # Write the whole request/response record with a single append
+            self._log(log_file, "".join(log_lines))
 
     def process_response(self, response_text, data=None):
         """
@@ -745,48 +1305,33 @@ class LLMAgent:
         if not response_text:
             return "Error: No response from LLM."
 
-        print(f"[DEBUG] Raw response has {response_text.count(chr(10))} newlines")
+        print(f"[DEBUG] Raw response has {len(response_text)} chars")
 
-        # Remove common termination tags if present
-        termination_tags = ["</stop>", "</xml>", "<|end|>", "<|endoftext|>"]
+        # Truncate at the first termination tag, if any (nothing after it is kept)
         processed_text = response_text
-        for tag in termination_tags:
-            if tag in processed_text:
-                termination_index = processed_text.find(tag)
-                processed_text = processed_text[:termination_index]
-                break
-
-        # Clean up any remaining termination tags
-        for tag in termination_tags:
-            processed_text = processed_text.replace(tag, "")
+        termination = _TERMINATION_RE.search(processed_text)
+        if termination:
+            processed_text = processed_text[:termination.start()]
 
-        print(f"[DEBUG] After tag removal has {processed_text.count(chr(10))} newlines")
+        print(f"[DEBUG] After tag removal has {len(processed_text)} chars")
 
         # Clean up oblique tags from the response
         processed_text = self._clean_oblique_tags(processed_text)
 
-        print(f"[DEBUG] After oblique tag cleaning has {processed_text.count(chr(10))} newlines")
+        print(f"[DEBUG] After oblique tag cleaning has {len(processed_text)} chars")
 
-        # Handle different modes
-        if data and data.get('mode') == 'self':
-            print(f"[DEBUG] Processing in SELF mode")
-            # For self mode, stop sequences handle the boundaries automatically
-            # Just return the cleaned response directly
-            final_result = processed_text.strip()
-            print(f"[DEBUG] Self mode result: {len(final_result)} chars")
-        else:
-            print(f"[DEBUG] Processing in FULL mode (mode: {data.get('mode') if data else 'None'})")
-            # For full mode, return the entire response (cleaned)
-            final_result = processed_text.strip()
+        # Both modes return the cleaned response as is: in self mode the stop sequences
+        # already end it at the next speaker, and full mode keeps the whole exchange
+        final_result = processed_text.strip()
+        print(f"[DEBUG] Processed in {data.get('mode', 'full') if data else 'full'} mode: {len(final_result)} chars")
 
         # Prepend seed text if provided - the seed was used as prefill in the prompt,
         # but the LLM response only contains the continuation, so we need to add it back
-        if data and data.get('seed'):
-            seed_text = data.get('seed')
+        seed_text = data.get('seed') if data else None
+        if seed_text:
             final_result = f"{seed_text} {final_result}" if final_result else seed_text
             print(f"[DEBUG] Prepended seed text: '{seed_text}'")
 
-        print(f"[DEBUG] Final processed result has {final_result.count(chr(10))} newlines")
         return final_result
 
     def _extract_user_content_colon_format(self, text, username):
@@ -800,6 +1345,7 @@ class LLMAgent:
         print(f"[DEBUG] Text length: {len(text)} characters")
         
         lines = text.split('\n')
+        target = username.lower()  # Compared against every speaker line, so lower it once
         user_content = []
         in_user_section = True  # Start in user section for prefill models
         found_explicit_user_line = False  # Track if we found an explicit speaker line for the user
@@ -816,16 +1362,17 @@ class LLMAgent:
             is_speaker_line = self._is_likely_speaker_line_colon(line)
             
             if is_speaker_line:
-                speaker_part = line.split(':', 1)[0].strip()
+                speaker_part, _, content_after_colon = line.partition(':')
+                speaker_part = speaker_part.strip()
                 print(f"[DEBUG] Line {i+1}: Found speaker line: '{speaker_part}' (target: '{username}')")
                 
                 # If this line starts with our target username
-                if speaker_part.lower() == username.lower():
+                if speaker_part.lower() == target:
                     print(f"[DEBUG] Line {i+1}: MATCH! Starting to collect content for '{username}'")
                     in_user_section = True
                     found_explicit_user_line = True
                     # Add the content after the colon
-                    content_after_colon = line.split(':', 1)[1].strip()
+                    content_after_colon = content_after_colon.strip()
                     if content_after_colon:
                         user_content.append(content_after_colon)
                 else:
@@ -861,41 +1408,21 @@ class LLMAgent:
         - Speaker part should look like a name/identifier
         - Ignore colons followed by only whitespace (formatting like "Similarly:")
         """
-        if ':' not in line:
-            print(f"[DEBUG] Speaker check: No colon in line: {repr(line[:50])}")
-            return False
-            
-        colon_pos = line.find(':')
-        speaker_part = line[:colon_pos].strip()
-        content_after_colon = line[colon_pos + 1:].strip()
-        
-        print(f"[DEBUG] Speaker check: line={repr(line[:50])}, colon_pos={colon_pos}, speaker_part='{speaker_part}', content_after='{content_after_colon[:20]}'")
-        
-        # If there's no content after the colon (just whitespace), it's likely formatting, not a speaker
-        if not content_after_colon:
-            print(f"[DEBUG] Speaker check: No content after colon (formatting like 'Similarly:')")
+        # One match covers the colon position, the punctuation test and the text after the colon
+        match = _SPEAKER_LINE_RE.match(line)
+        if not match:
+            print(f"[DEBUG] Speaker check: Not a speaker line: {repr(line[:50])}")
             return False
-        
-        # Colon should be reasonably early in the line (not buried in a sentence)
-        if colon_pos > 30:
-            print(f"[DEBUG] Speaker check: Colon too far ({colon_pos} > 30)")
-            return False
-            
+
         # Speaker part should be reasonable length
-        if len(speaker_part) < 1 or len(speaker_part) > 25:
+        speaker_part = match.group(1).strip()
+        if not speaker_part or len(speaker_part) > 25:
             print(f"[DEBUG] Speaker check: Speaker part length invalid ({len(speaker_part)})")
             return False
             
-        # Speaker part shouldn't contain punctuation that's unlikely in names
-        # Allow spaces, hyphens, underscores, apostrophes, but not much else
-        invalid_chars = set('.,!?;()[]{}|\\/"<>+=*&^%$#@`~')
-        if any(char in invalid_chars for char in speaker_part):
-            print(f"[DEBUG] Speaker check: Invalid chars in speaker part")
-            return False
-            
         # Speaker part shouldn't contain numbers in patterns that suggest time/dates
         # e.g., "3:00", "12:30", "2023:01"
-        if any(char.isdigit() for char in speaker_part):
+        if any(map(str.isdigit, speaker_part)):
             # If it's all digits or digits with common time separators, probably not a speaker
             cleaned = speaker_part.replace(' ', '').replace('-', '').replace(':', '')
             if cleaned.isdigit() or len(cleaned) <= 4:
@@ -911,41 +1438,46 @@ class LLMAgent:
         Extract content for a specific user from XML-formatted text.
         This handles multi-line responses better by looking for the user's section.
         """
-        lines = text.split('\n')
-        user_content = []
-        in_user_section = False
-        
-        for line in lines:
-            line_stripped = line.strip()
-            if not line_stripped:
-                if in_user_section:
-                    user_content.append('')  # Keep empty lines within user section
-                continue
-                
-            # Check if this line starts a new speaker with XML tags
-            if line_stripped.startswith('<') and '>' in line_stripped:
-                # Extract the tag name
-                end_tag_pos = line_stripped.find('>')
-                tag_content = line_stripped[1:end_tag_pos]
-                
-                # If this tag matches our target username
-                if tag_content.lower() == username.lower():
-                    in_user_section = True
-                    # Add the content after the tag
-                    content_after_tag = line_stripped[end_tag_pos + 1:].strip()
-                    if content_after_tag:
-                        user_content.append(content_after_tag)
-                else:
-                    # This line starts with a different speaker, stop collecting
-                    if in_user_section:
+        target = username.lower()  # Compared against every tag, so lower it once
+
+        # Jump straight to the user's first tag instead of walking the lines before it
+        start = None
+        user_tag_re = _xml_speaker_tag_re(target)
+        for match in user_tag_re.finditer(text):
+            line_start = text.rfind('\n', 0, match.start()) + 1
+            # The tag must open its line, and the case-insensitive match is only a prefilter
+            if text[line_start:match.start()].isspace() or line_start == match.start():
+                if match.group(1).lower() == target:
+                    start = line_start
+                    break
+        if start is None:
+            return ''
+
+        # Walk the lines with find() rather than split(): the section usually ends at the next
+        # speaker tag, and the rest of the transcript after it is never sliced into lines
+        parts = []
+        end = len(text)
+        while start <= end:
+            newline = text.find('\n', start)
+            if newline < 0:
+                newline = end
+            line = text[start:newline].strip()
+            start = newline + 1
+            if line[:1] == '<':
+                tag_content, closed, content_after_tag = line[1:].partition('>')
+                if closed:
+                    if tag_content.lower() != target:
+                        # This line starts with a different speaker, stop collecting
                         break
-                    in_user_section = False
-            else:
-                # This is a continuation line (no XML tag at start)
-                if in_user_section:
-                    user_content.append(line_stripped)
-        
-        return '\n'.join(user_content)
+                    # Add the content after the tag (the line is already stripped on the right)
+                    content_after_tag = content_after_tag.lstrip()
+                    if content_after_tag:
+                        parts.append(content_after_tag)
+                    continue
+            # Continuation line; empty lines are kept within the user section
+            parts.append(line)
+
+        return '\n'.join(parts)
 
     def _clean_oblique_tags(self, text):
         """
@@ -958,19 +1490,19 @@ class LLMAgent:
         Returns:
             str: The cleaned text.
         """
-        # Remove [oblique:username] patterns
-        text = re.sub(r'\[oblique:[^\]]*\]', '', text)
-        
-        # Remove standalone [oblique] tags
-        text = text.replace('[oblique]', '')
-        
-        # Clean up excessive spaces but preserve newlines
-        # Replace multiple spaces with single space, but keep newlines
-        text = re.sub(r'[ \t]+', ' ', text)  # Only collapse spaces and tabs, not newlines
+        # Remove [oblique:username] patterns, then standalone [oblique] tags (most responses have neither).
+        # The order matters: removing an inner [oblique:...] can leave an [oblique] behind
+        if '[oblique' in text:
+            text = _OBLIQUE_USER_TAG_RE.sub('', text)
+            text = text.replace('[oblique]', '')
         
-        # Clean up any trailing spaces on lines
-        text = re.sub(r' +\n', '\n', text)  # Remove spaces before newlines
-        text = re.sub(r'\n +', '\n', text)  # Remove spaces after newlines
+        # Remove spaces around newlines, then collapse remaining runs of spaces and tabs.
+        # Each pass only runs if the text has something it would change
+        has_tab = '\t' in text
+        if has_tab or ' \n' in text or '\n ' in text:
+            text = _NEWLINE_PADDING_RE.sub('\n', text)
+        if has_tab or '  ' in text:
+            text = _INLINE_SPACE_RE.sub(' ', text)
         
         return text.strip()
 
@@ -984,50 +1516,71 @@ class LLMAgent:
         Returns:
             str: The cleaned username.
         """
-        return re.sub(r'\[.*?\]', '', username).strip()
+        return _strip_bracketed(username)
 
     async def enqueue_message(self, data):
-        print(f"[DEBUG] LLMAgent.enqueue_message called for {self.name}")
-        print(f"[DEBUG] Queue size before: {self.queue.qsize()}")
-        await self.queue.put(data)
-        print(f"[DEBUG] Message added to queue, size now: {self.queue.qsize()}")
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # Reject the newest trigger right away rather than let the user wait on a backlog
+            print(f"[WARNING] Queue full for {self.name}, rejecting message")
+            await self.callback(data, "Too many generations are queued right now. Please try again in a moment.", page=1, total_pages=1)
+            return
+        # Start fetching the history now so it is ready by the time a handler picks up the item
+        history_task = _start_task(self.format_messages(data['message'], data.get('bot')))
+        self._prefetch_tasks.add(history_task)
+        history_task.add_done_callback(self._prefetch_tasks.discard)
+        data['_history_task'] = history_task
+        print(f"[DEBUG] Queued message for {self.name} ({self.queue.qsize()} waiting)")
 
     async def shutdown(self):
-        self.task.cancel()
+        """
+        Stop the agent: cancel its work, flush the request logs and close the HTTP session.
+
+        Safe to call more than once or concurrently; every call waits for the same shutdown.
+        """
+        if self._shutdown_task is None:
+            self._shutdown_task = asyncio.create_task(self._shutdown())
+        # Shielded so a caller that is itself cancelled does not abort the shutdown halfway
+        await asyncio.shield(self._shutdown_task)
+
+    async def _shutdown(self, timeout=5):
+        tasks = {self.task, *self._handler_tasks, *self._prefetch_tasks}
+        for task in tasks:
+            task.cancel()
+        # Bounded, so a task that swallows its cancellation cannot hang the shutdown
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in done:
+            if not task.cancelled():
+                task.exception()  # Retrieve it so it is not reported as never retrieved
+        if pending:
+            print(f"[WARNING] {len(pending)} task(s) of {self.name} did not stop within {timeout}s")
+        # Flush pending request logs before stopping the writer
+        try:
+            await asyncio.wait_for(self._log_queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"[WARNING] Timed out flushing request logs for {self.name}")
+        self._log_task.cancel()
+        await asyncio.wait({self._log_task}, timeout=timeout)
         try:
-            await self.task
-        except asyncio.CancelledError:
-            pass
-        await self.session.close()
+            await asyncio.wait_for(self.session.close(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"[WARNING] Timed out closing the HTTP session of {self.name}")
 
-    def _extract_usernames_from_messages(self, formatted_messages):
+    def _stop_sequences(self, author_names):
         """
-        Extract unique usernames from formatted messages to use as stop sequences.
-        
+        Builds the stop sequences for a history: one "name:" per speaker, using the same
+        cleaned name that starts the speaker's prompt lines.
+
         Args:
-            formatted_messages (str): The formatted chat history
-            
+            author_names (Iterable[str]): Author names of the formatted messages.
+
         Returns:
             list[str]: List of unique usernames followed by colons
         """
-        usernames = set()
-        lines = formatted_messages.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # For colon format, extract username before first colon
-            if ':' in line:
-                potential_username = line.split(':', 1)[0].strip()
-                # Basic validation - should look like a username
-                if (len(potential_username) > 0 and 
-                    len(potential_username) <= 25 and
-                    not any(char in potential_username for char in '.,!?;()[]{}|\\/"<>+=*&^%$#@`~')):
-                    usernames.add(potential_username)
-        
-        # Convert to stop sequences (username + colon)
-        stop_sequences = [f"{username}:" for username in usernames]
+        usernames = dict.fromkeys(map(self._clean_username, author_names))
+        # Basic validation - should look like a username
+        stop_sequences = [f"{username}:" for username in usernames
+                          if 0 < len(username) <= 25 and _INVALID_NAME_CHARS.isdisjoint(username)]
         print(f"[DEBUG] Extracted stop sequences: {stop_sequences}")
         return stop_sequences
@@ -0,0 +1,241 @@
+import asyncio
+import re
+import statistics
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+
+# Longest pause we will honour from a provider header, to guard against bogus values
+MAX_PAUSE_SECONDS = 60.0
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+def _parse_seconds(value):
+    """
+    Parse a rate-limit header value into a number of seconds from now.
+
+    Accepts plain seconds ("2"), epoch timestamps in seconds or milliseconds
+    (OpenRouter's X-RateLimit-Reset), Go-style durations ("6m0s", "20ms") and
+    HTTP dates (Retry-After).
+
+    Returns:
+        float or None: Seconds to wait, or None if the value could not be parsed.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        number = float(value)
+    except ValueError:
+        pass
+    else:
+        if number > 1e12:  # Epoch milliseconds
+            return number / 1000 - time.time()
+        if number > 1e9:  # Epoch seconds
+            return number - time.time()
+        return number
+
+    matches = _DURATION_RE.findall(value)
+    if matches:
+        return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+    try:
+        return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+# Statuses that indicate the provider is overloaded and concurrency should back off
+BACKOFF_STATUSES = (429, 502, 503)
+
+
+class RateLimiter:
+    """
+    Paces requests to an LLM endpoint so they are throttled before the provider rejects them.
+
+    Concurrency is governed by an AIMD (additive-increase/multiplicative-decrease)
+    controller: the limit grows by `increase_step` while recent latencies stay under
+    `target_latency`, and halves on slow responses, 429/5xx statuses or connection
+    errors. On top of that the limiter keeps optional one-minute sliding windows for
+    requests and tokens, plus a shared pause deadline set from the provider's
+    rate-limit headers, so the completions fired for one prompt back off together
+    instead of each retrying into another 429.
+
+    Usage:
+        async with limiter:
+            started = time.monotonic()
+            async with session.post(...) as resp:
+                limiter.update_from_headers(resp.headers)
+                await limiter.record_result(resp.status, time.monotonic() - started)
+    """
+
+    def __init__(self, concurrency=5, min_concurrency=1, max_concurrency=16, target_latency=60.0,
+                 increase_step=0.5, requests_per_minute=None, tokens_per_minute=None, remaining_threshold=0.1):
+        self._concurrency = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.increase_step = increase_step
+        self._inflight = 0
+        self._condition = asyncio.Condition()
+        self._latencies = deque(maxlen=32)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.remaining_threshold = remaining_threshold
+        self._rpm_window = deque()  # monotonic timestamps of recent requests
+        self._tpm_window = deque()  # (monotonic timestamp, tokens) of recent responses
+        self._tokens_in_window = 0
+        self._pause_until = 0.0
+
+    @classmethod
+    def for_model(cls, model_config):
+        """
+        Create a limiter with the rate-limit settings of a model from models.yaml.
+
+        Args:
+            model_config (dict): The model's configuration.
+
+        Returns:
+            RateLimiter: The limiter.
+        """
+        return cls(
+            concurrency=5,
+            target_latency=model_config.get('target_latency', 60.0),
+            requests_per_minute=model_config.get('requests_per_minute'),
+            tokens_per_minute=model_config.get('tokens_per_minute')
+        )
+
+    @property
+    def concurrency(self):
+        """The number of requests currently allowed in flight."""
+        return int(self._concurrency)
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._inflight < self.concurrency)
+            self._inflight += 1
+        try:
+            await self.wait_if_throttled()
+        except BaseException:
+            await self._release(failed=False)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        failed = exc_type is not None and issubclass(exc_type, (aiohttp.ClientError, asyncio.TimeoutError))
+        await self._release(failed)
+        return False
+
+    async def _release(self, failed):
+        async with self._condition:
+            self._inflight -= 1
+            if failed:
+                self._decrease()
+            # After a shrink the freed slot may still be over the limit; waking a
+            # waiter then would only send it back to sleep
+            if self._inflight < self.concurrency:
+                self._condition.notify(1)
+
+    def _decrease(self):
+        """Multiplicatively shrink the concurrency limit."""
+        previous = self.concurrency
+        self._concurrency = max(self.min_concurrency, self._concurrency * 0.5)
+        self._latencies.clear()
+        if self.concurrency != previous:
+            print(f"[DEBUG] Rate limiter concurrency decreased to {self.concurrency}")
+
+    async def record_result(self, status, latency):
+        """
+        Feed a response back into the AIMD controller.
+
+        Args:
+            status (int): The HTTP status of the response.
+            latency (float): Seconds from sending the request to receiving the response.
+        """
+        async with self._condition:
+            if status in BACKOFF_STATUSES:
+                self._decrease()
+                return
+            if status != 200:
+                return
+            self._latencies.append(latency)
+            if statistics.fmean(self._latencies) > self.target_latency:
+                self._decrease()
+                return
+            previous = self.concurrency
+            self._concurrency = min(self.max_concurrency, self._concurrency + self.increase_step)
+            if self.concurrency != previous:
+                self._condition.notify_all()
+
+    def _trim(self, now):
+        """Drop window entries older than one minute."""
+        while self._rpm_window and now - self._rpm_window[0] >= 60:
+            self._rpm_window.popleft()
+        while self._tpm_window and now - self._tpm_window[0][0] >= 60:
+            self._tokens_in_window -= self._tpm_window.popleft()[1]
+
+    async def wait_if_throttled(self):
+        """
+        Sleep until a pause set from response headers has expired and both sliding
+        windows have capacity, then record the request in the request window.
+        """
+        while True:
+            now = time.monotonic()
+            self._trim(now)
+            delay = self._pause_until - now
+            if self.requests_per_minute and len(self._rpm_window) >= self.requests_per_minute:
+                delay = max(delay, self._rpm_window[0] + 60 - now)
+            if self.tokens_per_minute and self._tokens_in_window >= self.tokens_per_minute:
+                delay = max(delay, self._tpm_window[0][0] + 60 - now)
+            if delay <= 0:
+                break
+            print(f"[DEBUG] Rate limiter pausing request for {delay:.2f}s")
+            await asyncio.sleep(delay)
+        self._rpm_window.append(now)
+
+    def pause_for(self, seconds):
+        """Hold back every request on this limiter for at least `seconds`."""
+        seconds = min(max(seconds, 0.0), MAX_PAUSE_SECONDS)
+        self._pause_until = max(self._pause_until, time.monotonic() + seconds)
+
+    def record_usage(self, tokens):
+        """Add the tokens consumed by a completed request to the token window."""
+        if not tokens:
+            return
+        self._tpm_window.append((time.monotonic(), tokens))
+        self._tokens_in_window += tokens
+
+    def update_from_headers(self, headers):
+        """
+        Update the shared pause deadline from a response's rate-limit headers.
+
+        Honours Retry-After, and pauses until the advertised reset time once the
+        remaining request budget drops below `remaining_threshold` of the limit.
+        Understands both the OpenAI (x-ratelimit-*-requests) and OpenRouter
+        (X-RateLimit-*) header names.
+
+        Returns:
+            float or None: The Retry-After delay in seconds, if the response carried one.
+        """
+        retry_after = _parse_seconds(headers.get('retry-after'))
+        if retry_after is not None:
+            self.pause_for(retry_after)
+
+        remaining = headers.get('x-ratelimit-remaining-requests', headers.get('x-ratelimit-remaining'))
+        limit = headers.get('x-ratelimit-limit-requests', headers.get('x-ratelimit-limit'))
+        try:
+            remaining, limit = float(remaining), float(limit)
+        except (TypeError, ValueError):
+            return retry_after
+
+        if limit > 0 and remaining < limit * self.remaining_threshold:
+            reset = _parse_seconds(headers.get('x-ratelimit-reset-requests', headers.get('x-ratelimit-reset')))
+            pause = reset if reset is not None and reset > 0 else 1.0
+            print(f"[DEBUG] Rate limit nearly exhausted ({remaining:.0f}/{limit:.0f} remaining), pausing {pause:.2f}s")
+            self.pause_for(pause)
+        return retry_after
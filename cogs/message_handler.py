@@ -6,9 +6,11 @@ from discord.ext import commands
 from discord import ButtonStyle
 from discord.ui import Button, View
 import asyncio
-from agents.llm_agent import LLMAgent
+from agents.llm_agent import LLMAgent, create_connector
+from agents.rate_limiter import RateLimiter
 from collections import deque
 from generation.context import GenerationManager, GenerationContext
+from utils.history_cache import ChannelHistoryCache
 
 
 class MessageHandler(commands.Cog):
@@ -20,6 +22,14 @@ class MessageHandler(commands.Cog):
         self.agents = {}
         self.agents_lock = asyncio.Lock()
         self.generation_manager = GenerationManager()
+        # Recent messages per channel, kept current from gateway events and shared by all agents
+        self.history_cache = ChannelHistoryCache(maxlen=config.MESSAGE_HISTORY_LIMIT * 2)
+        # Connection pool shared by all agents, so models on the same provider reuse
+        # connections and DNS lookups (created with the first agent, inside the event loop)
+        self.connector = None
+        # One rate limiter per model, shared by the agents of every user, so the provider sees
+        # a single paced client per model rather than one per user
+        self.rate_limiters = {}  # Format: {(endpoint, model_id, api_key_env): RateLimiter}
 
     async def model_autocomplete(
         self,
@@ -195,6 +205,8 @@ class MessageHandler(commands.Cog):
     @commands.Cog.listener()
     async def on_ready(self):
         print('MessageHandler Cog is ready.')
+        # Events may have been missed while disconnected, so cached history can't be trusted
+        self.history_cache.clear()
         await self.webhook_manager.initialize_webhooks()
         try:
             # Sync the command tree with Discord
@@ -277,8 +289,24 @@ class MessageHandler(commands.Cog):
 
         return '\n'.join(lines)
 
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+        self.history_cache.handle_edit(payload)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        self.history_cache.remove(payload.channel_id, payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            self.history_cache.remove(payload.channel_id, message_id)
+
     @commands.Cog.listener()
     async def on_message(self, message):
+        # Track every message, including our own webhook output, for prompt history
+        self.history_cache.add(message)
+
         # Prevent the bot from responding to its own messages or webhooks
         if message.author == self.bot.user or isinstance(message.author, discord.Webhook):
             return
@@ -507,7 +535,7 @@ class MessageHandler(commands.Cog):
         async with self.agents_lock:
             if model_key not in self.agents:
                 # Define the callback function to handle the LLM's response
-                async def llm_callback(data, replacement_text, page, total_pages):
+                async def llm_callback(data, replacement_text, page, total_pages, partial=False):
                     """
                     Callback function to handle the LLM's response.
 
@@ -516,6 +544,8 @@ class MessageHandler(commands.Cog):
                         replacement_text (str): The text generated by the LLM.
                         page (int): The current page number.
                         total_pages (int): The total number of pages.
+                        partial (bool): Whether the text is a preview of a completion that is
+                            still streaming; it is shown but not added to the generation history.
                     """
                     try:
                         # Get webhook name and context
@@ -535,11 +565,12 @@ class MessageHandler(commands.Cog):
                             print(f"Channel with ID {data['channel_id']} not found.")
                             return
 
-                        # Add the new generation to context
-                        await context.add_generation(replacement_text)
+                        # Add the new generation to context (previews only replace the displayed text)
+                        if not partial:
+                            await context.add_generation(replacement_text)
                         
                         # Use appropriate view based on generation state
-                        view = self.create_generation_view(context) if len(context.history) > 0 else self.create_cancel_view()
+                        view = self.create_generation_view(context) if len(context.history) > 0 and not partial else self.create_cancel_view()
 
                         # Add page information to the content
                         content_with_page = f"{replacement_text}"
@@ -597,7 +628,15 @@ class MessageHandler(commands.Cog):
                         import traceback
                         traceback.print_exc()
 
-                agent = LLMAgent(name=f"Agent_{model_key}", config=self.config, callback=llm_callback, model_config=model_config)
+                if self.connector is None or self.connector.closed:
+                    self.connector = create_connector(self.config)
+                limiter_key = (model_config.get('endpoint'), model_config.get('model_id'),
+                               model_config.get('api_key_env'))
+                if limiter_key not in self.rate_limiters:
+                    self.rate_limiters[limiter_key] = RateLimiter.for_model(model_config)
+                agent = LLMAgent(name=f"Agent_{model_key}", config=self.config, callback=llm_callback,
+                                 model_config=model_config, history_cache=self.history_cache,
+                                 connector=self.connector, rate_limiter=self.rate_limiters[limiter_key])
                 self.agents[model_key] = agent
                 print(f"Created new LLM agent for user ID {user_id} with model config {model_key}")
             return self.agents[model_key]
@@ -610,6 +649,11 @@ class MessageHandler(commands.Cog):
             for agent in self.agents.values():
                 await agent.shutdown()
             self.agents.clear()
+            self.rate_limiters.clear()
+            # The agents' sessions do not own the shared connector, so close it once here
+            if self.connector is not None:
+                await self.connector.close()
+                self.connector = None
         print("MessageHandler Cog has been unloaded and agents have been shut down.")
 
     @commands.Cog.listener()
@@ -93,6 +93,12 @@ class Config:
         cls.KEYWORD = bot_config.get('keyword', 'obliqueme')
         cls.RANDOM_STRING_LENGTH = bot_config.get('random_string_length', 10)
         cls.MESSAGE_HISTORY_LIMIT = bot_config.get('message_history_limit', 80)
+        cls.CONNECTION_LIMIT = bot_config.get('connection_limit', 100)
+        cls.CONNECTION_LIMIT_PER_HOST = bot_config.get('connection_limit_per_host', 32)
+        cls.AGENT_WORKERS = bot_config.get('agent_workers', 4)
+        cls.RETRY_BASE_DELAY = bot_config.get('retry_base_delay', 0.5)
+        cls.RETRY_MAX_DELAY = bot_config.get('retry_max_delay', 60.0)
+        cls.MAX_RETRY_WAIT = bot_config.get('max_retry_wait', 120.0)
     
     # Legacy properties for backward compatibility - these will use default model
     @classmethod
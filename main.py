@@ -4,6 +4,11 @@ from discord.ext import commands
 import asyncio
 import logging
 
+try:
+    import uvloop  # Optional: faster event loop (not available on Windows)
+except ImportError:
+    uvloop = None
+
 from config import Config
 from cogs.webhook_manager import WebhookManager
 from cogs.message_handler import MessageHandler
@@ -39,7 +44,10 @@ def main():
             await bot.start(Config.BOT_TOKEN)
 
     try:
-        asyncio.run(run_bot())
+        if uvloop is not None:
+            uvloop.run(run_bot())
+        else:
+            asyncio.run(run_bot())
     except KeyboardInterrupt:
         print("Bot is shutting down.")
     except Exception as e:
@@ -0,0 +1,181 @@
+"""
+Per-channel cache of recent Discord messages, kept current from gateway events.
+"""
+
+from collections import deque
+
+
+class _ChannelWindow:
+    """
+    The most recent messages of one channel, oldest first and without gaps.
+    """
+
+    def __init__(self, maxlen, messages, complete, live_ids):
+        self.messages = deque(messages, maxlen=maxlen)
+        # True while the window reaches back to the very first message of the channel
+        self.complete = complete
+        # Messages received through on_message are the client's own cached objects,
+        # which discord.py updates in place when they are edited
+        self.live_ids = set(live_ids)
+
+    def append(self, message):
+        messages = self.messages
+        if messages and message.id <= messages[-1].id:
+            if any(cached.id == message.id for cached in messages):
+                return
+            # Out-of-order delivery: rebuild in id (creation) order
+            ordered = sorted([*messages, message], key=lambda m: m.id)
+            messages.clear()
+            messages.extend(ordered[-messages.maxlen:])
+            if len(ordered) > messages.maxlen:
+                self.complete = False
+        else:
+            if len(messages) == messages.maxlen:
+                self.complete = False
+                self.live_ids.discard(messages[0].id)
+            messages.append(message)
+        self.live_ids.add(message.id)
+
+
+class _PendingSeed:
+    """
+    Messages and edits seen for a channel while its window is being fetched.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.dirty = False
+
+
+class ChannelHistoryCache:
+    """
+    Caches the latest messages of each channel so repeated generations in the same
+    channel do not re-fetch history from the Discord REST API.
+
+    A channel's window is seeded by one `channel.history()` call and then kept up to
+    date by feeding gateway events into `add`, `handle_edit` and `remove`.
+    Reads that the window cannot answer fall back to the REST API.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self._windows = {}  # Format: {channel_id: _ChannelWindow}
+        self._pending = {}  # Format: {channel_id: _PendingSeed}
+
+    def add(self, message):
+        """
+        Record a newly created message (call from on_message).
+
+        Args:
+            message (discord.Message): The message received from the gateway.
+        """
+        channel_id = message.channel.id
+        if window := self._windows.get(channel_id):
+            window.append(message)
+        elif pending := self._pending.get(channel_id):
+            pending.messages.append(message)
+
+    def handle_edit(self, payload):
+        """
+        Invalidate a channel whose cached copy of an edited message would go stale.
+
+        Messages that came from on_message and are still in the client's message
+        cache are updated in place by discord.py, so only the others need a refetch.
+
+        Args:
+            payload (discord.RawMessageUpdateEvent): The raw edit event.
+        """
+        if pending := self._pending.get(payload.channel_id):
+            pending.dirty = True
+        window = self._windows.get(payload.channel_id)
+        if not window or not any(cached.id == payload.message_id for cached in window.messages):
+            return
+        if payload.message_id not in window.live_ids or payload.cached_message is None:
+            print(f"[DEBUG] Invalidating history cache for channel {payload.channel_id} after edit")
+            self._windows.pop(payload.channel_id, None)
+
+    def remove(self, channel_id, message_id):
+        """
+        Drop a deleted message from its channel's window (call from on_raw_message_delete).
+
+        Args:
+            channel_id (int): The channel the message was in.
+            message_id (int): The deleted message's ID.
+        """
+        if pending := self._pending.get(channel_id):
+            pending.dirty = True
+        if window := self._windows.get(channel_id):
+            for cached in window.messages:
+                if cached.id == message_id:
+                    window.messages.remove(cached)
+                    window.live_ids.discard(message_id)
+                    break
+
+    def clear(self):
+        """Forget every window, e.g. after a reconnect may have missed events."""
+        self._windows.clear()
+
+    def _lookup(self, channel_id, before_id, limit):
+        """
+        Answer a history query from the cached window.
+
+        Returns:
+            list or None: Up to `limit` messages newest first, or None if the window
+            does not cover the requested range.
+        """
+        window = self._windows.get(channel_id)
+        if window is None:
+            return None
+        if before_id is None:
+            candidates = list(window.messages)
+        else:
+            candidates = [msg for msg in window.messages if msg.id < before_id]
+        if len(candidates) >= limit:
+            return candidates[::-1][:limit]
+        if window.complete:
+            return candidates[::-1]
+        return None
+
+    async def _seed(self, channel):
+        """Fetch the latest messages of a channel and start tracking it."""
+        pending = self._pending[channel.id] = _PendingSeed()
+        try:
+            fetched = [msg async for msg in channel.history(limit=self.maxlen)]
+        finally:
+            self._pending.pop(channel.id, None)
+        if pending.dirty:
+            print(f"[DEBUG] Channel {channel.id} changed while seeding history cache, not caching")
+            return
+
+        messages = {msg.id: msg for msg in fetched}
+        messages.update((msg.id, msg) for msg in pending.messages)
+        ordered = sorted(messages.values(), key=lambda m: m.id)
+        self._windows[channel.id] = _ChannelWindow(
+            maxlen=self.maxlen,
+            messages=ordered[-self.maxlen:],
+            complete=len(fetched) < self.maxlen and len(ordered) <= self.maxlen,
+            live_ids=(msg.id for msg in pending.messages)
+        )
+        print(f"[DEBUG] Seeded history cache for channel {channel.id} with {len(ordered)} messages")
+
+    async def history(self, channel, limit, before=None):
+        """
+        Get a channel's history like `channel.history(limit=limit, before=before)`.
+
+        Args:
+            channel (discord.abc.Messageable): The channel or thread to read.
+            limit (int): Maximum number of messages to return.
+            before (discord.abc.Snowflake, optional): Only return messages older than this.
+
+        Returns:
+            list[discord.Message]: Messages, newest first.
+        """
+        before_id = before.id if before is not None else None
+        cached = self._lookup(channel.id, before_id, limit)
+        if cached is None and channel.id not in self._windows and channel.id not in self._pending:
+            await self._seed(channel)
+            cached = self._lookup(channel.id, before_id, limit)
+        if cached is not None:
+            print(f"[DEBUG] Served {len(cached)} messages for channel {channel.id} from history cache")
+            return cached
+        return [msg async for msg in channel.history(limit=limit, before=before)]